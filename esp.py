@@ -1,6 +1,75 @@
 from machine import UART, Pin
+import micropython
 import time
 
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+@micropython.native
+def _parse_fields(line):
+    """ Split the comma separated fields of an AT reply line (with the +XXX:
+        prefix already removed) into ints and strings, walking the bytes
+        once rather than split/decode/int/strip on every field
+    """
+    fields = []
+    end = len(line)
+    i = 0
+    while i < end:
+        if line[i] == 34:  # '"', a string which may itself contain commas
+            j = i + 1
+            while j < end and line[j] != 34:
+                j += 1
+            fields.append(str(line[i + 1:j], "utf-8"))
+            i = j + 2  # past the closing quote and the comma
+            continue
+        
+        j = i
+        neg = False
+        if line[j] == 45:  # '-'
+            neg = True
+            j += 1
+        start = j
+        val = 0
+        digits = True
+        while j < end and line[j] != 44:  # ','
+            c = line[j]
+            if 48 <= c <= 57:
+                val = val * 10 + c - 48
+            else:
+                digits = False
+            j += 1
+        
+        if digits and j > start:
+            fields.append(-val if neg else val)
+        else:
+            fields.append(str(line[i:j], "utf-8"))
+        i = j + 1
+    return fields
+
+def _iter_lines(buf):
+    """ Yield (start, end) offsets of each CR LF separated line in buf
+        without making a list of copies the way split() does
+    """
+    pos = 0
+    while True:
+        nl = buf.find(b"\r\n", pos)
+        if nl < 0:
+            if pos < len(buf):
+                yield pos, len(buf)
+            return
+        yield pos, nl
+        pos = nl + 2
+
+def _find_line(buf, prefix):
+    """ Return the first line in buf that starts with prefix, or None
+    """
+    for start, end in _iter_lines(buf):
+        if buf.startswith(prefix, start):
+            return buf[start:end]
+    return None
+
 class ESP:   
     STATUS_APCONNECTED = 2
     STATUS_SOCKETOPEN = 3
@@ -11,13 +80,47 @@ class ESP:
     MODE_SOFTAP = 2
     MODE_SOFTAPSTATION = 3
     
+    # things the ESP sends that mark the end of a reply
+    _OK = b"OK\r\n"
+    _ERROR = b"ERROR\r\n"
+    _FAIL = b"FAIL\r\n"  # how AT 1.x ends a failed AT+CWJAP=
+    _GOT_IP = b"WIFI GOT IP\r\n"
+    _CONNECTED = b"WIFI CONNECTED\r\n"
+    _ERR_CODE = b"ERR CODE:"
+    _SEND_OK = b"SEND OK\r\n"
+    _SEND_FAIL = b"SEND FAIL\r\n"
+    _BUSY = b"busy"
+    _PROMPT = b">"
+    
+    # the terminators are always in the last line or two of a reply, so
+    # this much of the end of it is all _reply_state needs to look at
+    _TAIL = 32
+    
+    # what _reply_state makes of the reply so far
+    _REPLY_MORE = 0
+    _REPLY_OK = 1
+    _REPLY_FAILED = 2
+    _REPLY_ERR_CODE = 3  # failed, but the ERROR line that follows is still to come
+    
+    # how long to wait for that ERROR line before giving up on it
+    _ERR_CODE_MS = 100
+    
+    # reinit() won't grow the UART rx buffer past this, the rp2 port
+    # won't take much more
+    _MAX_RX_BUFFER = 32768
+    
+    # how long a cached mode / remote_AP answer is trusted for
+    _CACHE_MS = 1000
+    
     def __init__(self,
                  uart_id=0,
                  tx_pin=0,
                  rx_pin=1,
                  baud_rate=115200,
                  tx_buffer=1024,
-                 rx_buffer=2048,
+                 rx_buffer=4096,
+                 cts_pin=None,
+                 rts_pin=None,
                  debug=False
                  ):
         """ initialise the UART for the ESP8266 module
@@ -25,86 +128,509 @@ class ESP:
             
             Default to UART 0, tx pin 0, rx pin 1
             Valid pins for UARTS are: UART0: tx=0/12/16, rx=1/13/17, UART1: tx=4/8, rx=5/9
+            
+            If the ESP's CTS/RTS lines are wired up give both pins to turn on
+            hardware flow control, so the ESP waits rather than us losing bytes
+            Valid pins are: UART0: cts=2/14/18, rts=3/15/19, UART1: cts=6/10, rts=7/11
         """
         self._debug = debug
+        self._uart_id = uart_id
+        self._tx_pin = tx_pin
+        self._rx_pin = rx_pin
+        self._cts_pin = cts_pin
+        self._rts_pin = rts_pin
+        self._baud_rate = baud_rate
+        self._tx_buffer = tx_buffer
+        self._rx_buffer = rx_buffer
+        
+        # most the UART has had waiting for us, if it ever fills the rx
+        # buffer bytes will have been dropped, see _rx_high_water()
+        self._max_seen_any = 0
+        self._rx_overflowed = False
+        
+        # scratch space the replies are read into, kept between commands
+        # so we're not making garbage for every AT command
+        self._rx_buf = bytearray(4096)
+        self._rx_mv = memoryview(self._rx_buf)
+        
+        # last answers to AT+CWMODE? and AT+CWJAP?, see invalidate_cache()
+        self._cached_mode = None
+        self._cached_mode_stamp = 0
+        self._cached_ap = None
+        self._cached_ap_stamp = 0
+        
+        # the queries the properties keep making, ready to go
+        self._cmd_status = self._make_sender("AT+CIPSTATUS", timeout=5)
+        self._cmd_remote_ap = self._make_sender("AT+CWJAP?", timeout=10)
+        self._cmd_mode = self._make_sender("AT+CWMODE?", timeout=5)
+        self._cmd_local_ip = self._make_sender("AT+CIFSR")
+        
+        self._init_uart()
+    
+    def _init_uart(self):
+        """ (re)create the UART from the stored settings
+        """
+        self._rx_overflowed = False
+        self._max_seen_any = 0
+        
+        flow = {}
+        if self._cts_pin is not None and self._rts_pin is not None:
+            flow = {"cts": Pin(self._cts_pin),
+                    "rts": Pin(self._rts_pin),
+                    "flow": UART.CTS | UART.RTS}
         
         try:
-            self._uart = UART(uart_id,
-                              baudrate=baud_rate,
-                              tx=Pin(tx_pin),
-                              rx=Pin(rx_pin),
-                              txbuf=tx_buffer,
-                              rxbuf=rx_buffer
+            self._uart = UART(self._uart_id,
+                              baudrate=self._baud_rate,
+                              tx=Pin(self._tx_pin),
+                              rx=Pin(self._rx_pin),
+                              txbuf=self._tx_buffer,
+                              rxbuf=self._rx_buffer,
+                              **flow
                               )
         except:
             self._uart = None
+    
+    def invalidate_cache(self):
+        """ Forget the cached mode and remote_AP so the next read of either
+            asks the ESP again
+        """
+        self._cached_mode = None
+        self._cached_ap = None
+    
+    def set_rx_buffer(self, rx_buffer):
+        """ Change the size of the UART receive buffer, the UART is
+            reinitialised so anything already received is lost
+        """
+        self._rx_buffer = rx_buffer
+        self._init_uart()
+    
+    def reinit(self):
+        """ Reinitialise the UART, first doubling the receive buffer (up to
+            _MAX_RX_BUFFER) if it has filled up since the UART was last set
+            up. Anything already received is lost
+        """
+        old_size = self._rx_buffer
+        if self._rx_overflowed:
+            self._rx_buffer = min(self._rx_buffer * 2, self._MAX_RX_BUFFER)
+            if self._rx_buffer == old_size:
+                print("ESP: UART rx buffer already %d bytes, not growing it" % old_size)
+        self._init_uart()
+        
+        if self._uart is None and self._rx_buffer != old_size:
+            # the port wouldn't take the bigger buffer, go back to what worked
+            print("ESP: couldn't grow UART rx buffer to %d bytes, keeping %d"
+                  % (self._rx_buffer, old_size))
+            self._rx_buffer = old_size
+            self._init_uart()
+    
+    def _rx_high_water(self, n):
+        """ The UART had more waiting, n, than we've seen before. If that's
+            the whole rx buffer warn that bytes have probably been dropped and
+            flag the buffer to be made bigger by the next reinit()
+        """
+        self._max_seen_any = n
+        if n >= self._rx_buffer and not self._rx_overflowed:
+            print("ESP: UART rx buffer (%d bytes) full, data may be lost, "
+                  "reinit() will grow it" % self._rx_buffer)
+            self._rx_overflowed = True
             
     def ping(self, host):
         """ Ping the IP or hostname given, returns ms time or None on failure
         """
         reply = self.send_at_cmd('AT+PING="%s"' % host.strip('"'), timeout=5)
-        for line in reply.split(b"\r\n"):
-            if line and line.startswith(b"+"):
-                try:
-                    if line[1:5] == b"PING":
-                        return int(line[6:])
-                    return int(line[1:])
-                except ValueError:
-                    return None
+        line = _find_line(reply, b"+")
+        if line:
+            try:
+                if line[1:5] == b"PING":
+                    return int(line[6:])
+                return int(line[1:])
+            except ValueError:
+                return None
         raise RuntimeError("Couldn't ping")
 
-    def send_at_cmd(self, at_cmd, timeout=20, retries=3):
+    def _write_cmd(self, payload):
+        """ Clear out the UART and write an AT command, already encoded and
+            with its CR LF on the end, to the ESP in one go
+        """
+        if self._debug:
+            print("tx ---> ", payload)
+        
+        # throw away anything left over from an earlier command so it
+        # doesn't end up in front of this reply
+        if self._uart.any():
+            self._uart.read()
+        
+        self._uart.write(payload)
+    
+    def _send_raw(self, buf):
+        """ Write buf (bytes, bytearray or a memoryview slice) to the ESP as
+            it is, for data after a '>' prompt rather than AT commands.
+            Returns the number of bytes written
+        """
+        if self._debug:
+            print("tx ---> ", len(buf), "bytes")
+        return self._uart.write(buf)
+    
+    def _grow_rx_buf(self, size):
+        """ Make the scratch receive buffer at least size bytes, keeping
+            what's already in it, and return the new buffer and its view
+        """
+        new_size = len(self._rx_buf)
+        while new_size < size:
+            new_size *= 2
+        buf = bytearray(new_size)
+        buf[:len(self._rx_buf)] = self._rx_buf
+        self._rx_buf = buf
+        self._rx_mv = memoryview(buf)
+        return self._rx_buf, self._rx_mv
+    
+    def _read_reply(self, check, timeout_ms, off=0):
+        """ Read from the UART into the scratch buffer, from off onwards,
+            until check(buf, start, end) returns something other than None
+            or timeout_ms runs out. buf[start:end] is what's come in since
+            the last time the received data ended in a whole line.
+            Returns what check returned (None on timeout) and end
+        """
+        # look these up once rather than on every pass of the read loop
+        uart_any = self._uart.any
+        uart_readinto = self._uart.readinto
+        ticks_ms = time.ticks_ms
+        ticks_diff = time.ticks_diff
+        rx_buf = self._rx_buf
+        rx_mv = self._rx_mv
+        
+        stamp = ticks_ms()
+        line_start = off
+        while ticks_diff(ticks_ms(), stamp) < timeout_ms:
+            n = uart_any()
+            if n:
+                if n > self._max_seen_any:
+                    self._rx_high_water(n)
+                # pull everything the driver has in one call
+                if off + n > len(rx_buf):
+                    rx_buf, rx_mv = self._grow_rx_buf(off + n)
+                n = uart_readinto(rx_mv[off:off + n])
+                if not n:
+                    continue
+                off += n
+                result = check(rx_buf, line_start, off)
+                if result is not None:
+                    return result, off
+                if rx_buf[off - 1] == 10:
+                    line_start = off
+        return None, off
+    
+    async def _read_reply_async(self, sreader, check, timeout_ms, off=0):
+        """ uasyncio version of _read_reply, reading through sreader
+        """
+        stamp = time.ticks_ms()
+        line_start = off
+        while True:
+            remaining = timeout_ms - time.ticks_diff(time.ticks_ms(), stamp)
+            if remaining <= 0:
+                break
+            if off == len(self._rx_buf):
+                self._grow_rx_buf(off * 2)
+            try:
+                n = await asyncio.wait_for(sreader.readinto(self._rx_mv[off:]),
+                                           remaining / 1000)
+            except asyncio.TimeoutError:
+                break
+            if n:
+                # what we got plus what's still waiting is how full it was
+                waiting = n + self._uart.any()
+                if waiting > self._max_seen_any:
+                    self._rx_high_water(waiting)
+                off += n
+                result = check(self._rx_buf, line_start, off)
+                if result is not None:
+                    return result, off
+                if self._rx_buf[off - 1] == 10:
+                    line_start = off
+        return None, off
+    
+    def _reply_check(self, is_cwjap, is_ping):
+        """ Make the check _read_reply uses to spot the end of an AT reply
+        """
+        reply_state = self._reply_state
+        
+        def check(buf, start, end):
+            # only whole lines can finish off a reply
+            if buf[end - 1] != 10:
+                return None
+            return reply_state(buf, start, end, is_cwjap, is_ping) or None
+        
+        return check
+    
+    def _reply_state(self, buf, start, end, is_cwjap, is_ping):
+        """ Check whether the end of the lines in buf[start:end] finishes off
+            the reply, only called when buf[end - 1] is the end of a line.
+            Returns _REPLY_OK when we've got the answer, _REPLY_FAILED when
+            the ESP has given up (_REPLY_ERR_CODE if its ERROR line hasn't
+            arrived yet), or _REPLY_MORE to keep reading
+        """
+        tail = buf[max(start, end - self._TAIL):end]
+        if tail[-4:] == self._OK:
+            return self._REPLY_OK
+        if tail[-7:] == self._ERROR:
+            # a failed ping is still an answer
+            return self._REPLY_OK if is_ping else self._REPLY_FAILED
+        if is_cwjap:
+            if self._GOT_IP in tail:
+                return self._REPLY_OK
+            if tail[-6:] == self._FAIL:
+                return self._REPLY_FAILED
+        else:
+            if self._CONNECTED in tail:
+                return self._REPLY_FAILED
+        if self._ERR_CODE in tail:
+            return self._REPLY_ERR_CODE
+        return self._REPLY_MORE
+    
+    def _error_check(self, buf, start, end):
+        """ _read_reply check that stops at an ERROR line
+        """
+        if buf[end - 7:end] == self._ERROR:
+            return True
+        return None
+    
+    def _reply_result(self, end, is_cwjap):
+        """ Turn a successful reply, the first end bytes of the scratch
+            buffer, into what send_at_cmd returns
+        """
+        response = bytes(self._rx_mv[:end])
+        if self._debug:
+            print("<--- rx ", response)
+        
+        if not is_cwjap and response.endswith(self._OK):
+            return response[:-4]
+        
+        return response
+    
+    def _reply_failed(self, end):
+        """ Log a reply that failed or timed out and return how many ms to
+            wait before retrying, depending on how it went wrong
+        """
+        response = bytes(self._rx_mv[:end])
+        if self._debug:
+            print("<--- rx ", response)
+        
+        if self._ERR_CODE in response:
+            return 0  # the ESP knows what's wrong and its ERROR has been read
+        if response.endswith(self._ERROR) or response.endswith(self._FAIL):
+            return 500
+        return 100  # nothing, or not all of it, came back
+
+    def send_at_cmd(self, at_cmd, timeout=20, retries=3, timeout_ms=None):
         """ Send an AT command, check that we got an OK response,
             and then return the text of the reply.
+            timeout is in seconds, or pass timeout_ms for finer control
         """
-        for _ in range(retries):
-            if self._debug:
-                print("tx ---> ", at_cmd)
+        return self._transact(retries, *self._prepare(at_cmd, timeout, timeout_ms))
+    
+    def _prepare(self, at_cmd, timeout, timeout_ms=None):
+        """ Work out everything about an AT command that doesn't change
+            between attempts, returns (at_cmd, payload, timeout_ms, is_cwjap,
+            is_ping) ready to pass on to _transact
+        """
+        if timeout_ms is None:
+            timeout_ms = timeout * 1000
+        return (at_cmd,
+                at_cmd.encode() + b"\r\n",
+                timeout_ms,
+                "AT+CWJAP=" in at_cmd,
+                "AT+PING" in at_cmd)
+    
+    def _make_sender(self, at_cmd, timeout=20, retries=3):
+        """ Return a function that sends this one AT command, with the
+            encoding and command checks send_at_cmd does already done
+        """
+        args = self._prepare(at_cmd, timeout)
+        transact = self._transact
+        
+        def sender():
+            return transact(retries, *args)
+        
+        return sender
+    
+    def _transact(self, retries, at_cmd, payload, timeout_ms, is_cwjap, is_ping):
+        """ The guts of send_at_cmd, write the encoded payload and read the
+            reply, retrying until we get a good one
+        """
+        check = self._reply_check(is_cwjap, is_ping)
+        
+        for attempt in range(retries):
+            self._write_cmd(payload)
+            state, off = self._read_reply(check, timeout_ms)
+            if state == self._REPLY_OK:
+                return self._reply_result(off, is_cwjap)
+            if state == self._REPLY_ERR_CODE:
+                # read the ERROR that follows ERR CODE now, otherwise it turns
+                # up at the front of the next attempt's reply
+                _, off = self._read_reply(self._error_check, self._ERR_CODE_MS, off)
             
-            self._uart.write(bytes(at_cmd, "utf-8"))
-            self._uart.write(b"\x0d\x0a")
-            stamp = time.time()
-            response = b""
+            delay = self._reply_failed(off)
+            if delay and attempt < retries - 1:
+                time.sleep_ms(delay)
+        
+        raise RuntimeError("No OK response to " + at_cmd)
+    
+    async def send_at_cmd_async(self, at_cmd, timeout=20, retries=3, timeout_ms=None):
+        """ uasyncio version of send_at_cmd, other tasks keep running while
+            we wait for the ESP to reply.
+        """
+        at_cmd, payload, timeout_ms, is_cwjap, is_ping = self._prepare(
+            at_cmd, timeout, timeout_ms)
+        
+        sreader = asyncio.StreamReader(self._uart)
+        check = self._reply_check(is_cwjap, is_ping)
+        
+        for attempt in range(retries):
+            self._write_cmd(payload)
+            state, off = await self._read_reply_async(sreader, check, timeout_ms)
+            if state == self._REPLY_OK:
+                return self._reply_result(off, is_cwjap)
+            if state == self._REPLY_ERR_CODE:
+                # read the ERROR that follows ERR CODE now, otherwise it turns
+                # up at the front of the next attempt's reply
+                _, off = await self._read_reply_async(sreader, self._error_check,
+                                                      self._ERR_CODE_MS, off)
             
-            while (time.time() - stamp) < timeout:
-                if self._uart.any():
-                    response += self._uart.read(1)
-                    if response[-4:] == b"OK\r\n":
-                        break
-                    if response[-7:] == b"ERROR\r\n":
-                        break
-                    if "AT+CWJAP=" in at_cmd:
-                        if b"WIFI GOT IP\r\n" in response:
-                            break
-                    else:
-                        if b"WIFI CONNECTED\r\n" in response:
-                            break
-                    if b"ERR CODE:" in response:
+            delay = self._reply_failed(off)
+            if delay and attempt < retries - 1:
+                await asyncio.sleep(delay / 1000)
+        
+        raise RuntimeError("No OK response to " + at_cmd)
+    
+    def _read_until(self, stops, timeout_ms, left=0, multi=True):
+        """ Read the ESP's lines until one of stops turns up or timeout_ms
+            runs out, counting the SEND OKs on the way.
+            A line matches a stop if it starts or ends with it, the '>'
+            prompt only counts at the start of a line, and +IPD data from
+            the other end is skipped by its length (multi says whether it
+            has a link ID) so nothing in it is taken for one of ours.
+            left is how many bytes the last call didn't get to, which it
+            moved to the front of the scratch buffer.
+            Returns the stop found (None on timeout), the SEND OK count and
+            the new left
+        """
+        acks = 0
+        pos = 0  # everything in the scratch buffer before this is dealt with
+        
+        def check(buf, start, end):
+            nonlocal acks, pos
+            data = bytes(self._rx_mv[pos:end])
+            i = 0
+            found = None
+            while i < len(data) and found is None:
+                if data.startswith(b"+IPD,", i):
+                    colon = data.find(b":", i)
+                    if colon < 0:
+                        break  # wait for the rest of the header
+                    fields = data[i + 5:colon].split(b",")
+                    size = int(fields[1] if multi else fields[0])
+                    if colon + 1 + size > len(data):
+                        break  # wait for the rest of the data
+                    i = colon + 1 + size
+                    continue
+                
+                if data[i] == 62:  # '>', no CR LF and maybe a space after it
+                    i += 1
+                    if i < len(data) and data[i] == 32:
+                        i += 1
+                    if self._PROMPT in stops:
+                        found = self._PROMPT
+                    continue
+                
+                nl = data.find(b"\n", i)
+                if nl < 0:
+                    break  # wait for the rest of the line
+                line = data[i:nl + 1]
+                i = nl + 1
+                if self._debug:
+                    print("<--- rx ", line)
+                if line.endswith(self._SEND_OK):
+                    acks += 1
+                for stop in stops:
+                    if line.startswith(stop) or line.endswith(stop):
+                        found = stop
                         break
+            pos += i
+            return found
+        
+        # what the last call left behind may already hold what we want
+        stop = check(self._rx_buf, 0, left) if left else None
+        off = left
+        if stop is None:
+            stop, off = self._read_reply(check, timeout_ms, left)
+        
+        # keep whatever came in after the stop for next time
+        left = off - pos
+        if left:
+            self._rx_buf[:left] = bytes(self._rx_mv[pos:off])
+        return stop, acks, left
+    
+    def send_data(self, link, data, max_pending=4, frame_size=2048, timeout=10):
+        """ Send data down an open connection with AT+CIPSENDBUF, link is
+            the link ID or None in single connection mode.
+            Up to max_pending frames of frame_size bytes are handed to the
+            ESP before we wait for the first one's SEND OK.
+            Returns how many bytes the ESP confirmed sending, which is less
+            than len(data) if it was busy or the connection failed.
+            Any +IPD data the other end sends meanwhile is thrown away
+        """
+        timeout_ms = timeout * 1000
+        mv = memoryview(data)
+        pending = []  # lengths of the frames still waiting for SEND OK
+        pos = 0
+        sent = 0
+        left = 0  # bytes _read_until hasn't got to yet
+        
+        # only clear the UART once, the SEND OKs for our own frames can
+        # turn up in the middle of the next AT+CIPSENDBUF
+        if self._uart.any():
+            self._uart.read()
+        
+        while pos < len(mv) or pending:
+            if pos < len(mv) and len(pending) < max_pending:
+                frame = mv[pos:pos + frame_size]
+                if link is None:
+                    at_cmd = "AT+CIPSENDBUF=%d" % len(frame)
+                else:
+                    at_cmd = "AT+CIPSENDBUF=%d,%d" % (link, len(frame))
+                if self._debug:
+                    print("tx ---> ", at_cmd)
+                self._uart.write(at_cmd.encode() + b"\r\n")
+                stop, acks, left = self._read_until(
+                    (self._PROMPT, self._ERROR, self._BUSY), timeout_ms,
+                    left, link is not None)
+            else:
+                stop, acks, left = self._read_until(
+                    (self._SEND_OK, self._SEND_FAIL, self._ERROR), timeout_ms,
+                    left, link is not None)
             
-            if self._debug:
-                print("<--- rx ", response)
-     
-            if "AT+CWJAP=" in at_cmd and b"WIFI GOT IP\r\n" in response:
-                return response
-
-            if "AT+PING" in at_cmd and b"ERROR\r\n" in response:
-                return response
-            
-            if response[-4:] != b"OK\r\n":
-                time.sleep(1)
-                continue
+            for _ in range(acks):
+                if pending:
+                    sent += pending.pop(0)
             
-            return response[:-4]
+            if stop is self._PROMPT:
+                self._send_raw(frame)
+                pending.append(len(frame))
+                pos += len(frame)
+            elif stop is not self._SEND_OK:
+                # timed out, busy, or the send failed, leave it to the caller
+                break
         
-        raise Exception("No OK response to " + at_cmd)
+        return sent
     
-    def connect(self, secrets):
+    def connect(self, secrets, retries=3):
         """ Repeatedly try to connect to an access point with the details in
             the passed in 'secrets' dictionary.
+            Backs off 1, 2, 4... (at most 30) seconds between attempts and
+            returns False if none of them worked
         """
-        retries = 3
-        while True:
+        for attempt in range(retries):
             try:
                 AP = self.remote_AP
                 if AP[0] != secrets["ssid"]:
@@ -112,8 +638,9 @@ class ESP:
                 return True
             except (RuntimeError) as exp:
                 print("Failed to connect, retrying\n", exp)
-                retries -= 1
-                continue
+                if attempt < retries - 1:
+                    time.sleep(min(2 ** attempt, 30))
+        return False
   
     def soft_reset(self):
         """ soft_reset: perform a soft reset of the ESP8266
@@ -121,6 +648,8 @@ class ESP:
         if self._uart == None:
             return False
 
+        # the module comes back up disconnected, don't trust what we knew
+        self.invalidate_cache()
         reply = self.send_at_cmd("AT+RST", timeout=1)
         if reply.strip(b"\r\n") == b"AT+RST":
             time.sleep(2)
@@ -146,61 +675,66 @@ class ESP:
     @property
     def status(self):
         """The IP connection status number (see AT+CIPSTATUS datasheet for meaning)"""
-        replies = self.send_at_cmd("AT+CIPSTATUS", timeout=5).split(b"\r\n")
-        for reply in replies:
-            if reply.startswith(b"STATUS:"):
-                return int(reply[7:8])
+        reply = _find_line(self._cmd_status(), b"STATUS:")
+        if reply:
+            return int(reply[7:8])
         return None
     
     @property
     def remote_AP(self):
         """The name of the access point we're connected to, as a string"""
+        if (self._cached_ap is not None and
+                time.ticks_diff(time.ticks_ms(), self._cached_ap_stamp) < self._CACHE_MS):
+            return list(self._cached_ap)
+        
+        self._cached_ap = self._query_remote_AP()
+        self._cached_ap_stamp = time.ticks_ms()
+        # a copy, so the caller changing it doesn't change the cache
+        return list(self._cached_ap)
+    
+    def _query_remote_AP(self):
+        """ Ask the ESP which access point we're connected to
+        """
         stat = self.status
 
         if stat != self.STATUS_APCONNECTED:
             return [None] * 4
         
-        replies = self.send_at_cmd("AT+CWJAP?", timeout=10).split(b"\r\n")
-
-        for reply in replies:
-            if not reply.startswith("+CWJAP:"):
-                continue
-            reply = reply[7:].split(b",")
-            for i, val in enumerate(reply):
-                reply[i] = str(val, "utf-8")
-                try:
-                    reply[i] = int(reply[i])
-                except ValueError:
-                    reply[i] = reply[i].strip('"')  # its a string!
-            
-            return reply
+        reply = _find_line(self._cmd_remote_ap(), b"+CWJAP:")
+        if reply:
+            return _parse_fields(reply[7:])
         
         return [None] * 4
     
     @property
     def mode(self):
-        replies = self.send_at_cmd("AT+CWMODE?", timeout=5).split(b"\r\n")
-        for reply in replies:
-            if reply.startswith(b"+CWMODE:"):
-                return int(reply[8:])
+        if (self._cached_mode is not None and
+                time.ticks_diff(time.ticks_ms(), self._cached_mode_stamp) < self._CACHE_MS):
+            return self._cached_mode
+        
+        reply = _find_line(self._cmd_mode(), b"+CWMODE:")
+        if reply:
+            self._cached_mode = int(reply[8:])
+            self._cached_mode_stamp = time.ticks_ms()
+            return self._cached_mode
         raise RuntimeError("Bad response to CWMODE?")
     
     @mode.setter
     def mode(self, mode):
         """Station or AP mode selection, can be MODE_STATION, MODE_SOFTAP or MODE_SOFTAPSTATION"""
-        if not self._initialized:
-            self.begin()
         if not mode in (1, 2, 3):
             raise RuntimeError("Invalid Mode")
-        self.at_response("AT+CWMODE=%d" % mode, timeout=3)
+        self.invalidate_cache()
+        self.send_at_cmd("AT+CWMODE=%d" % mode, timeout=3)
+        self._cached_mode = mode
+        self._cached_mode_stamp = time.ticks_ms()
     
     @property
     def local_ip(self):
         """Our local IP address as a dotted-quad string"""
-        reply = self.send_at_cmd("AT+CIFSR").strip(b"\r\n")
-        for line in reply.split(b"\r\n"):
-            if line and line.startswith(b'+CIFSR:STAIP,"'):
-                return str(line[14:-1], "utf-8")
+        line = _find_line(self._cmd_local_ip(), b'+CIFSR:STAIP,"')
+        if line:
+            return str(line[14:-1], "utf-8")
         raise RuntimeError("Couldn't find IP address")
     
     def join_ap(self, ssid, password):  # pylint: disable=invalid-name
@@ -213,18 +747,19 @@ class ESP:
         router = self.remote_AP
         if router and router[0] == ssid:
             return  # we're already connected!
-        for _ in range(3):
-            reply = self.send_at_cmd(
-                'AT+CWJAP="' + ssid + '","' + password + '"', timeout=15, retries=3
-            )
+        # whatever happens we won't be on the same AP as before
+        self.invalidate_cache()
+        # only the one attempt, connect() owns retrying
+        reply = self.send_at_cmd(
+            'AT+CWJAP="' + ssid + '","' + password + '"', timeout=15, retries=1
+        )
 
-            if b"WIFI CONNECTED" not in reply:
-                print("no CONNECTED")
-                #raise RuntimeError("Couldn't connect to WiFi")
-            if b"WIFI GOT IP" not in reply:
-                print("no IP")
-                #raise RuntimeError("Didn't get IP address")
-            return
+        if b"WIFI CONNECTED" not in reply:
+            print("no CONNECTED")
+            #raise RuntimeError("Couldn't connect to WiFi")
+        if b"WIFI GOT IP" not in reply:
+            print("no IP")
+            #raise RuntimeError("Didn't get IP address")
     
     def get_APs(self, retries=3):
         """Ask the module to scan for access points and return a list of lists
@@ -234,19 +769,12 @@ class ESP:
             try:
                 if self.mode != self.MODE_STATION:
                     self.mode = self.MODE_STATION
-                scan = self.send_at_cmd("AT+CWLAP", timeout=5).split(b"\r\n")
+                scan = self.send_at_cmd("AT+CWLAP", timeout=5)
             except RuntimeError:
                 continue
             routers = []
             
-            for line in scan:
-                if line.startswith(b"+CWLAP:("):
-                    router = line[8:-1].split(b",")
-                    for i, val in enumerate(router):
-                        router[i] = str(val, "utf-8")
-                        try:
-                            router[i] = int(router[i])
-                        except ValueError:
-                            router[i] = router[i].strip('"')  # its a string!
-                    routers.append(router)
+            for start, end in _iter_lines(scan):
+                if scan.startswith(b"+CWLAP:(", start):
+                    routers.append(_parse_fields(scan[start + 8:end - 1]))
             return routers